@@ -6,10 +6,24 @@ HEADERS = {"Authorization": f"Bearer {API_KEY}"}
 # Defaults (the code will auto-adjust if API returns 413/504 etc.)
 DEFAULT_CHUNK_SIZE = 10  # was 25
 MIN_CHUNK_SIZE = 5  # floor for auto-shrinking
+CHUNK_CACHE_SIZE = 64  # shrunk chunk PDFs kept in memory for reuse
 REQUEST_TIMEOUT = 300  # seconds
 MAX_RETRIES = 3
 RETRY_SLEEP_BASE = 2  # seconds (exponential backoff)
 
 # NEW
-POLL_SLEEP_SEC = 2  # wait between polls
+POLL_INITIAL_SLEEP = 0.1  # first wait between polls (seconds)
+POLL_BACKOFF_BASE = 1.3  # wait grows as INITIAL * BASE**attempt
+POLL_MAX_SLEEP = 5.0  # cap on a single wait
 POLL_MAX_SECONDS = 240  # per chunk, per mode
+POLL_STATUS_HEADER = "X-Processing-Status"  # checked via HEAD before fetching bodies
+
+# Parallel chunk submission (network-bound, so threads are fine)
+MAX_WORKERS = 8  # chunks in flight per mode
+
+# Upload compression: gzip the request body when it saves at least 10%
+GZIP_UPLOADS = True  # set False if the server rejects Content-Encoding: gzip
+GZIP_MIN_RATIO = 0.9  # send gzip only if compressed < ratio * raw
+
+# Shared HTTP/2 client in utils.py (HTTP/2 needs httpx[http2]; plain httpx uses HTTP/1.1)
+HTTP_MAX_CONNECTIONS = 32  # HTTP/1.1 fallback only (4 modes x MAX_WORKERS)
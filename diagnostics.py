@@ -1,6 +1,6 @@
 # diagnostics.py
 import os, sys
-from pypdf import PdfReader
+import pikepdf
 
 
 def human(n):  # bytes -> human-readable
@@ -25,31 +25,32 @@ def main():
     print(f"📄 File: {path}")
     print(f"   Size: {human(size)}")
 
+    # pikepdf (QPDF) resolves page objects from its cached xref, and tries the
+    # empty password on its own.
     try:
-        reader = PdfReader(path)
+        pdf = pikepdf.open(path)
+    except pikepdf.PasswordError as e:
+        print(f"🔐 Encrypted: YES (decrypt failed: {e})")
+        sys.exit(1)
     except Exception as e:
-        print(f"❌ PdfReader failed to open: {e}")
+        print(f"❌ pikepdf failed to open: {e}")
         sys.exit(1)
 
-    if getattr(reader, "is_encrypted", False):
-        try:
-            ok = reader.decrypt("")  # try empty password
-            print(f"🔐 Encrypted: YES (decrypt empty pwd ok={ok})")
-        except Exception as e:
-            print(f"🔐 Encrypted: YES (decrypt failed: {e})")
-            sys.exit(1)
+    if pdf.is_encrypted:
+        print("🔐 Encrypted: YES (decrypt empty pwd ok=True)")
     else:
         print("🔓 Encrypted: NO")
 
-    n = len(reader.pages)
+    pages = pdf.pages
+    n = len(pages)
     print(f"🧾 Pages: {n}")
 
     # sample 3 pages for mediabox sanity
     for idx in [0, n // 2, n - 1]:
         if idx < 0 or idx >= n:
             continue
-        mb = reader.pages[idx].mediabox
-        w, h = float(mb.width), float(mb.height)
+        x0, y0, x1, y1 = (float(v) for v in pages[idx].mediabox)
+        w, h = x1 - x0, y1 - y0
         print(f"   - Page {idx+1}: size = {w:.1f} × {h:.1f} (points)")
 
     print("✅ Diagnostics complete. If size > 80–100 MB, chunking is essential.")
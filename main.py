@@ -1,13 +1,20 @@
 # main.py
-import os
-from config import DEFAULT_CHUNK_SIZE, MIN_CHUNK_SIZE
+import os, re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import DEFAULT_CHUNK_SIZE, MIN_CHUNK_SIZE, MAX_WORKERS
 from utils import (
     split_pdf_to_chunks,
+    open_pdf,
+    close_pdf,
+    register_source,
+    build_chunk_bytes,
     post_extract,
-    save_text,
-    save_json,
+    enqueue_write,
+    flush_writes,
+    dumps_json,
     ensure_dir,
     _should_shrink,
+    ExtractHTTPError,
 )
 
 INPUT_PDF = "samples/annual_report.pdf"  
@@ -18,113 +25,145 @@ OUT_BOX_DIR = "output/boxes"
 OUT_TAB_DIR = "output/tables"
 OUT_HIER_DIR = "output/hierarchy"
 
+_CODE_RE = re.compile(r"\b(408|413|429|5\d\d)\b")
+
+
+def _process_chunk(start_page: int, end_page: int, pdf_bytes: bytes, mode: str):
+    """Worker body: returns (tag, result_or_exc) so the caller decides how to react."""
+    tag = f"p{start_page}-{end_page}"
+    print(
+        f"  -> [{mode}] chunk [{tag}] (pages {start_page}-{end_page}, size {len(pdf_bytes)/1024/1024:.2f} MB)"
+    )
+    try:
+        return tag, post_extract(pdf_bytes, output_type=mode)
+    except Exception as e:
+        return tag, e
+
 
 def extract_mode_adaptive(
-    input_pdf: str, mode: str, out_dir: str, merge_markdown=False
+    source_id: int, chunks, mode: str, out_dir: str, merge_markdown=False
 ):
-    """Run extraction with adaptive chunk size: shrink if the API complains."""
+    """Run extraction with adaptive chunk size: shrink if the API complains.
+    `source_id` comes from register_source() and `chunks` are its pre-split
+    (start, end, bytes) ranges, shared by every mode; the source is only re-read
+    to build shrunk ranges."""
     print(f"\n=== Extracting {mode} ===")
-    ensure_dir(out_dir)
-
-    chunk_size = DEFAULT_CHUNK_SIZE
-    merged_md = []
-    start_page = 1
-
-    # We’ll manually stride through pages so we can retry the *same range* smaller on failure
-    # without resplitting the whole PDF.
-    import io
-    from pypdf import PdfReader, PdfWriter
-
-    reader = PdfReader(input_pdf)
-    total_pages = len(reader.pages)
-
-    while start_page <= total_pages:
-        end_page = min(start_page + chunk_size - 1, total_pages)
-        # Build this chunk
-        writer = PdfWriter()
-        for p in range(start_page - 1, end_page):
-            try:
-                writer.add_page(reader.pages[p])
-            except Exception as e:
-                print(f"⚠️ Skipping problematic page {p+1}: {e}")
-                from pypdf import PageObject
-
-                blank = PageObject.create_blank_page(width=612, height=792)
-                writer.add_page(blank)
-        buf = io.BytesIO()
-        writer.write(buf)
-        pdf_bytes = buf.getvalue()
-        tag = f"p{start_page}-{end_page}"
-        print(
-            f"  -> chunk [{tag}] (pages {start_page}-{end_page}, size {len(pdf_bytes)/1024/1024:.2f} MB)"
-        )
-
-        try:
-            res = post_extract(pdf_bytes, output_type=mode)
-        except Exception as e:
-            # If server likely wants smaller chunks, shrink and retry same range
-            msg = str(e)
-            code = None
-            # try to parse an HTTP code from the message
-            for c in ("408", "413", "429", "500", "502", "503", "504"):
-                if c in msg:
-                    code = int(c)
-                    break
-            if (
-                code is not None or _should_shrink(code or 0, msg)
-            ) and chunk_size > MIN_CHUNK_SIZE:
-                new_size = max(MIN_CHUNK_SIZE, chunk_size // 2)
-                print(
-                    f"🔁 Shrinking chunk size {chunk_size} → {new_size} and retrying same range."
+    ensure_dir(out_dir)  # once per mode; every output below lands in out_dir
+
+    merged_md = []  # (start_page, md) — chunks complete out of order
+
+    # A failing range is resubmitted smaller without resplitting the whole PDF.
+    # Neither pikepdf nor pypdf is thread-safe, so shrunk chunks are built here
+    # (under build_chunk_bytes' lock, as modes run concurrently) and only the
+    # network round-trips run on the pool.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        pending = {}  # future -> (start_page, end_page, chunk_size)
+
+        def submit(start_page, end_page, pdf_bytes, chunk_size):
+            fut = pool.submit(_process_chunk, start_page, end_page, pdf_bytes, mode)
+            pending[fut] = (start_page, end_page, chunk_size)
+
+        def submit_range(first_page, last_page, chunk_size):
+            for start_page in range(first_page, last_page + 1, chunk_size):
+                end_page = min(start_page + chunk_size - 1, last_page)
+                submit(
+                    start_page,
+                    end_page,
+                    build_chunk_bytes(source_id, start_page, end_page),
+                    chunk_size,
                 )
-                chunk_size = new_size
-                continue
-            else:
-                print(f"❌ Irrecoverable error on [{tag}]: {e}")
-                # Save a small error marker for audit
-                err_path = os.path.join(out_dir, f"{DOC_STEM}_{tag}.error.txt")
-                save_text(f"{e}", err_path)
-                # Skip this range to progress
-                start_page = end_page + 1
-                continue
-
-        # Save successful chunk
-        chunk_out = os.path.join(
-            out_dir,
-            f"{DOC_STEM}_{tag}.json" if mode != "markdown" else f"{DOC_STEM}_{tag}.md",
-        )
-        if mode == "markdown":
-            md = res.get("content", "")
-            save_text(md, chunk_out)
-            if merge_markdown:
-                merged_md.append(md.rstrip() + "\n\n<!-- PAGE-CHUNK BREAK -->\n\n")
-        else:
-            save_json(res, chunk_out)
-
-        # Advance to next range; keep current (possibly reduced) chunk_size
-        start_page = end_page + 1
-
-    # Merge markdown if requested
+
+        for start_page, end_page, pdf_bytes in chunks:
+            submit(start_page, end_page, pdf_bytes, DEFAULT_CHUNK_SIZE)
+
+        # as_completed() can't pick up futures submitted mid-iteration (shrunk retries),
+        # so drain with wait() instead.
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                start_page, end_page, chunk_size = pending.pop(fut)
+                tag, res = fut.result()
+
+                if isinstance(res, Exception):
+                    # If server likely wants smaller chunks, shrink and retry same range
+                    e = res
+                    msg = str(e)
+                    if isinstance(e, ExtractHTTPError):
+                        code = e.status_code
+                    else:
+                        # e.g. polling timeouts: the code only survives in the message
+                        m = _CODE_RE.search(msg)
+                        code = int(m.group(1)) if m else None
+                    if _should_shrink(code or 0, msg) and chunk_size > MIN_CHUNK_SIZE:
+                        new_size = max(MIN_CHUNK_SIZE, chunk_size // 2)
+                        print(
+                            f"🔁 [{mode}] Shrinking chunk size {chunk_size} → {new_size} and retrying [{tag}]."
+                        )
+                        submit_range(start_page, end_page, new_size)
+                    else:
+                        print(f"❌ [{mode}] Irrecoverable error on [{tag}]: {e}")
+                        # Save a small error marker for audit
+                        err_path = os.path.join(out_dir, f"{DOC_STEM}_{tag}.error.txt")
+                        enqueue_write(err_path, f"{e}".encode("utf-8"))
+                    continue
+
+                # Save successful chunk
+                ext = "md" if mode == "markdown" else "json"
+                chunk_out = os.path.join(out_dir, f"{DOC_STEM}_{tag}.{ext}")
+                if mode == "markdown":
+                    md = res.get("content", "")
+                    enqueue_write(chunk_out, md.encode("utf-8"))
+                    if merge_markdown:
+                        merged_md.append((start_page, md))
+                else:
+                    enqueue_write(chunk_out, dumps_json(res))
+
+    # Merge markdown if requested (restore page order)
     if merge_markdown and merged_md:
-        final_md = "".join(merged_md)
+        merged_md.sort(key=lambda item: item[0])
+        final_md = "".join(
+            md.rstrip() + "\n\n<!-- PAGE-CHUNK BREAK -->\n\n" for _, md in merged_md
+        )
         final_path = os.path.join(out_dir, f"{DOC_STEM}.md")
-        save_text(final_md, final_path)
-        print(f"✅ Merged markdown saved: {final_path}")
+        enqueue_write(final_path, final_md.encode("utf-8"))
+        print(f"✅ Merged markdown queued for writing: {final_path}")
 
 
 def main():
-    # 1) Markdown (merge)
-    extract_mode_adaptive(
-        INPUT_PDF, mode="markdown", out_dir=OUT_MD_DIR, merge_markdown=True
-    )
-    # 2) Boxes
-    extract_mode_adaptive(
-        INPUT_PDF, mode="ocr-with-bounding-boxes", out_dir=OUT_BOX_DIR
-    )
-    # 3) Tables
-    extract_mode_adaptive(INPUT_PDF, mode="tables", out_dir=OUT_TAB_DIR)
-    # 4) Hierarchy
-    extract_mode_adaptive(INPUT_PDF, mode="hierarchy_output", out_dir=OUT_HIER_DIR)
+    # Open and split once; all four modes reuse the same chunk bytes
+    src = open_pdf(INPUT_PDF)  # memory-mapped and shared by every mode's threads
+    failed_writes = []
+    try:
+        chunks = list(split_pdf_to_chunks(src, DEFAULT_CHUNK_SIZE))
+        source_id = register_source(src)
+
+        # The four modes are independent and network-bound, so run them side by side
+        # (each with its own MAX_WORKERS chunk pool).
+        modes = [
+            # 1) Markdown (merge)
+            dict(mode="markdown", out_dir=OUT_MD_DIR, merge_markdown=True),
+            # 2) Boxes
+            dict(mode="ocr-with-bounding-boxes", out_dir=OUT_BOX_DIR),
+            # 3) Tables
+            dict(mode="tables", out_dir=OUT_TAB_DIR),
+            # 4) Hierarchy
+            dict(mode="hierarchy_output", out_dir=OUT_HIER_DIR),
+        ]
+        with ThreadPoolExecutor(max_workers=len(modes)) as pool:
+            futures = [
+                pool.submit(extract_mode_adaptive, source_id, chunks, **kw)
+                for kw in modes
+            ]
+            for fut in futures:
+                fut.result()  # re-raise anything unexpected from a mode
+    finally:
+        # the writer thread is a daemon; don't lose queued outputs
+        failed_writes = flush_writes()
+        close_pdf(src)
+    if failed_writes:
+        print(f"\n❌ {len(failed_writes)} output file(s) could not be written:")
+        for out_path, e in failed_writes:
+            print(f"   - {out_path}: {e}")
     print(
         "\n🎉 All modes attempted. Check *.error.txt files (if any) for failing ranges."
     )
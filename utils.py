@@ -1,16 +1,61 @@
 # utils.py
-import io, json, time, requests
+import io, os, gzip, json, mmap, time, queue, functools, threading, orjson, httpx
 from urllib.parse import urlencode
+import pikepdf
+from pypdf import PdfReader, PdfWriter, PageObject
 from config import (
     URL,
     HEADERS,
     REQUEST_TIMEOUT,
-    POLL_SLEEP_SEC,
+    POLL_INITIAL_SLEEP,
+    POLL_BACKOFF_BASE,
+    POLL_MAX_SLEEP,
     POLL_MAX_SECONDS,
     MAX_RETRIES,
     RETRY_SLEEP_BASE,
+    HTTP_MAX_CONNECTIONS,
+    CHUNK_CACHE_SIZE,
+    GZIP_UPLOADS,
+    GZIP_MIN_RATIO,
+    POLL_STATUS_HEADER,
 )
 
+# httpx only speaks HTTP/2 with the optional h2 package (httpx[http2]); without it,
+# http2=True raises at import, so fall back to pooled HTTP/1.1.
+try:
+    import h2  # noqa: F401
+
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+# One HTTP/2 client for every submit/poll (thread-safe): all worker threads' requests
+# are multiplexed as streams over a single TCP+TLS connection. The limit only matters
+# on HTTP/1.1, where each in-flight request needs its own connection.
+# Retries are handled by post_extract.
+CLIENT = httpx.Client(
+    http2=_HTTP2,
+    headers=HEADERS,
+    timeout=REQUEST_TIMEOUT,
+    limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+    ),
+)
+
+
+class ExtractHTTPError(httpx.HTTPStatusError):
+    """The extract endpoint answered with an HTTP error status."""
+
+    def __init__(self, response: httpx.Response):
+        super().__init__(
+            f"HTTP {response.status_code}: {response.text[:500]}",
+            request=response.request,
+            response=response,
+        )
+        self.status_code = response.status_code
+        self.text = response.text
+
 
 def _print_server_error(resp, output_type):
     print(f"❌ HTTP {resp.status_code} for {output_type}. Server said:")
@@ -20,6 +65,59 @@ def _print_server_error(resp, output_type):
         pass
 
 
+# Which GET style the server answered with ("query" or "path"); None until the
+# first 200. Shared by every poll so later chunks issue only one GET per iteration.
+_POLL_STYLE = None
+_POLL_STYLE_LOCK = threading.Lock()
+
+
+def _remember_poll_style(style: str):
+    global _POLL_STYLE
+    if _POLL_STYLE is None:
+        with _POLL_STYLE_LOCK:
+            if _POLL_STYLE is None:
+                _POLL_STYLE = style
+
+
+_DONE = frozenset({"completed", "done", "finished", "succeeded"})
+
+
+def _status_of(data) -> str:
+    status = data.get("processing_status") or ""
+    return (status if isinstance(status, str) else str(status)).lower()
+
+
+def _is_done(data, status: str) -> bool:
+    """Heuristic: done when the status is in _DONE, or pages_processed > 0, or
+    content/tables are non-empty. Cheapest checks first."""
+    return (
+        status in _DONE
+        or int(data.get("pages_processed", 0)) > 0
+        or bool(data.get("content"))
+        or bool(data.get("tables"))
+    )
+
+
+# Whether HEAD on the poll URL reports POLL_STATUS_HEADER; None until the first probe.
+_HEAD_SUPPORTED = None
+
+
+def _head_status(url: str):
+    """Ask for the processing status via HEAD (no body). Returns it lowercased, or None
+    when unavailable; a server that doesn't send the header is never probed again."""
+    global _HEAD_SUPPORTED
+    if _HEAD_SUPPORTED is False:
+        return None
+    try:
+        resp = CLIENT.head(url)
+    except httpx.HTTPError:
+        return None
+    status = resp.headers.get(POLL_STATUS_HEADER) if resp.status_code == 200 else None
+    if _HEAD_SUPPORTED is None:
+        _HEAD_SUPPORTED = status is not None
+    return status.lower() if status else None
+
+
 def poll_until_ready(record_id: str):
     """
     Poll the GET endpoint until processing completes.
@@ -27,58 +125,79 @@ def poll_until_ready(record_id: str):
       GET /extract?record_id=...         (query param)
     or sometimes:
       GET /extract/<record_id>           (path param)
-    We try query first, then path.
+    We try query first, then path, and remember whichever answers first.
+    Waits back off exponentially (capped), restarting whenever the status changes.
+    Once the style is known, a HEAD is tried first and the body is only fetched when
+    the status header says it's finished (or the server doesn't send one).
     """
     deadline = time.time() + POLL_MAX_SECONDS
     last_err = None
+    last_status = None
+    attempt = 0
 
     while time.time() < deadline:
-        # Try query-param style
-        try:
-            q = {"record_id": str(record_id)}
-            resp = requests.get(
-                f"{URL}?{urlencode(q)}", headers=HEADERS, timeout=REQUEST_TIMEOUT
-            )
-            if resp.status_code == 200:
-                data = resp.json()
-                status = str(data.get("processing_status", "")).lower()
-                pages = int(data.get("pages_processed", 0))
-                # Heuristic: completed when status says done/complete or we see pages > 0 and content/tables present
-                if (
-                    status in {"completed", "done", "finished", "succeeded"}
-                    or pages > 0
-                    or data.get("content")
-                    or data.get("tables")
-                ):
-                    return data
+        style = _POLL_STYLE
+        query_ok = False
+
+        head_pending = False
+        if style is not None:
+            if style == "query":
+                poll_url = f"{URL}?{urlencode({'record_id': str(record_id)})}"
             else:
-                last_err = resp
-        except Exception as e:
-            last_err = e
+                poll_url = f"{URL}/{record_id}"
+            head = _head_status(poll_url)
+            if head is not None and head not in _DONE:
+                head_pending = True
+                if head != last_status:
+                    last_status = head
+                    attempt = 0
 
-        # Fallback: path-param style (ignore if 404)
-        try:
-            resp2 = requests.get(
-                f"{URL}/{record_id}", headers=HEADERS, timeout=REQUEST_TIMEOUT
-            )
-            if resp2.status_code == 200:
-                data2 = resp2.json()
-                status2 = str(data2.get("processing_status", "")).lower()
-                pages2 = int(data2.get("pages_processed", 0))
-                if (
-                    status2 in {"completed", "done", "finished", "succeeded"}
-                    or pages2 > 0
-                    or data2.get("content")
-                    or data2.get("tables")
-                ):
-                    return data2
-        except Exception:
-            pass
-
-        time.sleep(POLL_SLEEP_SEC)
+        # Try query-param style
+        if not head_pending and style in (None, "query"):
+            try:
+                q = {"record_id": str(record_id)}
+                resp = CLIENT.get(f"{URL}?{urlencode(q)}")
+                if resp.status_code == 200:
+                    query_ok = True
+                    _remember_poll_style("query")
+                    data = orjson.loads(resp.content)
+                    status = _status_of(data)
+                    if _is_done(data, status):
+                        return data
+                    if status != last_status:  # progress -> poll eagerly again
+                        last_status = status
+                        attempt = 0
+                else:
+                    last_err = resp
+            except Exception as e:
+                last_err = e
+
+        # Fallback: path-param style (ignore if 404); skipped once query is known to work
+        if not head_pending and (style == "path" or (style is None and not query_ok)):
+            try:
+                resp2 = CLIENT.get(f"{URL}/{record_id}")
+                if resp2.status_code == 200:
+                    _remember_poll_style("path")
+                    data2 = orjson.loads(resp2.content)
+                    status2 = _status_of(data2)
+                    if _is_done(data2, status2):
+                        return data2
+                    if status2 != last_status:
+                        last_status = status2
+                        attempt = 0
+                elif style == "path":
+                    last_err = resp2
+            except Exception as e:
+                if style == "path":
+                    last_err = e
+
+        time.sleep(
+            min(POLL_MAX_SLEEP, POLL_INITIAL_SLEEP * (POLL_BACKOFF_BASE**attempt))
+        )
+        attempt += 1
 
     # If we ran out of time, surface whatever we last got
-    if isinstance(last_err, requests.Response):
+    if isinstance(last_err, httpx.Response):
         _print_server_error(last_err, f"poll record_id={record_id}")
         raise RuntimeError(
             f"Polling timed out for record_id={record_id} (HTTP {last_err.status_code})"
@@ -86,57 +205,283 @@ def poll_until_ready(record_id: str):
     raise RuntimeError(f"Polling timed out for record_id={record_id}")
 
 
-def post_extract(file_bytes: bytes, output_type: str):
-    """Submit job, then poll until finished. Returns the FINAL result JSON."""
+# Set once the server has refused a gzipped body; every later upload goes out raw.
+_GZIP_REJECTED = False
+_GZIP_REJECT_CODES = {400, 415, 422}
+
+
+def _gzip_upload(file_bytes: bytes, output_type: str):
+    """Return a gzipped (body, headers) if it shrinks the multipart body enough, else None.
+    Content-Encoding covers the entire request body, so the file part alone can't be
+    gzipped."""
+    if not GZIP_UPLOADS or _GZIP_REJECTED:
+        return None
+    req = CLIENT.build_request(
+        "POST",
+        URL,
+        data={"output_type": output_type},
+        files={"file": ("chunk.pdf", file_bytes, "application/pdf")},
+    )
+    body, content_type = req.read(), req.headers["Content-Type"]
+    # level 1: near-free next to network time; image-heavy PDFs won't shrink
+    compressed = gzip.compress(body, compresslevel=1)
+    if len(compressed) < GZIP_MIN_RATIO * len(body):
+        return compressed, {"Content-Type": content_type, "Content-Encoding": "gzip"}
+    return None
+
+
+def _post_raw(file_bytes: bytes, output_type: str):
+    # httpx streams the multipart body instead of assembling it in memory;
+    # the file object is consumed by a send, so make a fresh one each attempt
+    return CLIENT.post(
+        URL,
+        data={"output_type": output_type},
+        files={"file": ("chunk.pdf", io.BytesIO(file_bytes), "application/pdf")},
+    )
+
+
+def _submit(file_bytes: bytes, output_type: str):
+    """POST the chunk (with retries) and return the parsed submit response.
+    Kept separate from polling so the upload body, and every response/request that
+    references it, is released before post_extract starts polling."""
+    global _GZIP_REJECTED
     last_err = None
+    gzipped = _gzip_upload(file_bytes, output_type)  # reused by every attempt
     for attempt in range(MAX_RETRIES):
         try:
-            file_obj = io.BytesIO(file_bytes)  # fresh each attempt
-            files = {"file": ("chunk.pdf", file_obj, "application/pdf")}
-            data = {"output_type": output_type}
-
-            resp = requests.post(
-                URL, headers=HEADERS, files=files, data=data, timeout=REQUEST_TIMEOUT
-            )
+            if gzipped:
+                body, headers = gzipped
+                resp = CLIENT.post(URL, content=body, headers=headers)
+                if resp.status_code in _GZIP_REJECT_CODES:
+                    # Most front ends don't decode gzipped request bodies; stop trying
+                    print(
+                        f"⚠️ HTTP {resp.status_code} on gzipped upload; sending uncompressed from now on."
+                    )
+                    _GZIP_REJECTED = True
+                    gzipped = None
+                    resp = _post_raw(file_bytes, output_type)
+            else:
+                resp = _post_raw(file_bytes, output_type)
 
             if resp.status_code >= 400:
                 _print_server_error(resp, output_type)
-                resp.raise_for_status()
+                raise ExtractHTTPError(resp)
 
             # Response may be either final or a receipt
             try:
-                data_out = resp.json()
-            except ValueError:
+                return orjson.loads(resp.content)
+            except ValueError:  # orjson.JSONDecodeError subclasses it
                 raise RuntimeError(
                     f"Response was not valid JSON. Snippet:\n{resp.text[:500]}"
                 )
 
-            status = str(data_out.get("processing_status", "")).lower()
-            content = data_out.get("content")
-            tables = data_out.get("tables")
-            pages = int(data_out.get("pages_processed", 0))
-            rid = data_out.get("record_id")
-
-            # If already done (some outputs finish synchronously), return
-            if (
-                status in {"completed", "done", "finished", "succeeded"}
-                or content
-                or tables
-                or pages > 0
-            ):
-                return data_out
-
-            # Otherwise we must poll; require a record_id
-            if not rid:
-                raise RuntimeError(
-                    f"Server returned no record_id; cannot poll. Body:\n{json.dumps(data_out)[:800]}"
-                )
-
-            return poll_until_ready(str(rid))
-
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             last_err = e
             print(f"⚠️ Attempt {attempt+1}/{MAX_RETRIES} failed: {e}")
             time.sleep(RETRY_SLEEP_BASE * (attempt + 1))
 
+    if isinstance(last_err, ExtractHTTPError):
+        raise last_err  # keep status_code for the caller's shrink decision
     raise RuntimeError(f"Extraction failed after {MAX_RETRIES} attempts: {last_err}")
+
+
+def post_extract(file_bytes: bytes, output_type: str):
+    """Submit job, then poll until finished. Returns the FINAL result JSON."""
+    data_out = _submit(file_bytes, output_type)
+
+    # If already done (some outputs finish synchronously), return
+    if _is_done(data_out, _status_of(data_out)):
+        return data_out
+
+    # Otherwise we must poll; require a record_id
+    rid = data_out.get("record_id")
+    if not rid:
+        raise RuntimeError(
+            f"Server returned no record_id; cannot poll. Body:\n{json.dumps(data_out)[:800]}"
+        )
+
+    return poll_until_ready(str(rid))
+
+
+def _should_shrink(code: int, msg: str) -> bool:
+    """Heuristic: does this failure look like the server wants a smaller chunk?"""
+    if code in {408, 413, 429} or 500 <= code <= 599:
+        return True
+    m = msg.lower()
+    return "timed out" in m or "timeout" in m or "too large" in m
+
+
+# Directories already created this run; skips the makedirs stat on every write.
+# Membership test + add on str keys are GIL-atomic, so worker threads can share it.
+_KNOWN_DIRS = set()
+
+
+def ensure_dir(path: str):
+    if path and path not in _KNOWN_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _KNOWN_DIRS.add(path)
+
+
+def _write_bytes(out_path: str, data: bytes):
+    # one encode upstream, one unbuffered write here
+    with open(out_path, "wb", buffering=0) as f:
+        f.write(data)
+
+
+def save_text(content: str, out_path: str):
+    ensure_dir(os.path.dirname(out_path))
+    _write_bytes(out_path, content.encode("utf-8"))
+
+
+def dumps_json(obj) -> bytes:
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+
+def save_json(obj, out_path: str):
+    ensure_dir(os.path.dirname(out_path))
+    _write_bytes(out_path, dumps_json(obj))
+
+
+# Background writer: extraction threads serialize to bytes and hand off the disk I/O,
+# so slow filesystems don't hold up network work. Call flush_writes() before exiting.
+_WRITE_QUEUE = queue.Queue()
+_WRITE_ERRORS = []  # (out_path, exc) for writes that failed; reported by flush_writes()
+
+
+def _writer_loop():
+    while True:
+        out_path, payload = _WRITE_QUEUE.get()
+        try:
+            _write_bytes(out_path, payload)
+        except Exception as e:
+            print(f"❌ Failed to write {out_path}: {e}")
+            _WRITE_ERRORS.append((out_path, e))
+        finally:
+            _WRITE_QUEUE.task_done()
+
+
+threading.Thread(target=_writer_loop, name="output-writer", daemon=True).start()
+
+
+def enqueue_write(out_path: str, payload: bytes):
+    """Queue already-serialized bytes for the background writer.
+    The parent directory must already exist (ensure_dir it once up front)."""
+    _WRITE_QUEUE.put((out_path, payload))
+
+
+def flush_writes():
+    """Block until every queued write is done; returns (out_path, exc) for failed ones."""
+    _WRITE_QUEUE.join()
+    failed = list(_WRITE_ERRORS)
+    _WRITE_ERRORS.clear()
+    return failed
+
+
+def _mmap_file(path: str):
+    f = open(path, "rb")
+    try:
+        return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception:
+        f.close()
+        raise
+
+
+# (file, mmap) backing each pypdf fallback reader; released by close_pdf()
+_MAPPINGS = {}
+
+
+def open_pdf(input_pdf: str):
+    """Open the source PDF with pikepdf (QPDF, C++); fall back to pypdf if QPDF refuses it.
+    Either way the file is memory-mapped, so only the xref and touched pages are paged in
+    (a path handed to pypdf would be read into memory whole). Release with
+    close_pdf()."""
+    try:
+        return pikepdf.open(input_pdf, access_mode=pikepdf.AccessMode.mmap)
+    except Exception as e:
+        print(f"⚠️ pikepdf could not open {input_pdf} ({e}); falling back to pypdf.")
+        f, mm = _mmap_file(input_pdf)
+        reader = PdfReader(mm)
+        _MAPPINGS[id(reader)] = (f, mm)
+        return reader
+
+
+def close_pdf(src):
+    if isinstance(src, pikepdf.Pdf):
+        src.close()
+    f_mm = _MAPPINGS.pop(id(src), None)
+    if f_mm:
+        f, mm = f_mm
+        mm.close()
+        f.close()
+
+
+def _pypdf_chunk_bytes(reader, start_page: int, end_page: int) -> bytes:
+    writer = PdfWriter()
+    for p in range(start_page - 1, end_page):
+        try:
+            writer.add_page(reader.pages[p])
+        except Exception as e:
+            print(f"⚠️ Skipping problematic page {p+1}: {e}")
+            blank = PageObject.create_blank_page(width=612, height=792)
+            writer.add_page(blank)
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def chunk_bytes(src, start_page: int, end_page: int) -> bytes:
+    """Serialize pages [start_page, end_page] (1-based, inclusive) of `src` into a
+    standalone PDF. `src` is whatever open_pdf() returned; a pikepdf failure retries
+    the range with pypdf."""
+    if isinstance(src, pikepdf.Pdf):
+        try:
+            dst = pikepdf.Pdf.new()
+            dst.pages.extend(src.pages[start_page - 1 : end_page])
+            buf = io.BytesIO()
+            dst.save(buf)
+            return buf.getvalue()
+        except Exception as e:
+            print(
+                f"⚠️ pikepdf failed on pages {start_page}-{end_page} ({e}); retrying with pypdf."
+            )
+            f, mm = _mmap_file(src.filename)
+            try:
+                return _pypdf_chunk_bytes(PdfReader(mm), start_page, end_page)
+            finally:
+                mm.close()
+                f.close()
+    return _pypdf_chunk_bytes(src, start_page, end_page)
+
+
+# open_pdf() results aren't hashable, so the chunk cache keys on id(src) instead.
+_SOURCES = {}
+# Modes run concurrently but a pikepdf/pypdf source isn't thread-safe.
+_SOURCE_LOCK = threading.Lock()
+
+
+def register_source(src) -> int:
+    """Make `src` addressable by build_chunk_bytes(); returns its source id."""
+    _SOURCES[id(src)] = src
+    return id(src)
+
+
+@functools.lru_cache(maxsize=CHUNK_CACHE_SIZE)
+def build_chunk_bytes(source_id: int, start_page: int, end_page: int) -> bytes:
+    """Cached chunk_bytes(): shrunk ranges repeat across retries and modes."""
+    with _SOURCE_LOCK:
+        return chunk_bytes(_SOURCES[source_id], start_page, end_page)
+
+
+def split_pdf_to_chunks(input_pdf, chunk_size: int):
+    """Yield (start_page, end_page, pdf_bytes) for consecutive page ranges (1-based, inclusive).
+    `input_pdf` may be a path or a source already returned by open_pdf()."""
+    owned = isinstance(input_pdf, str)
+    src = open_pdf(input_pdf) if owned else input_pdf
+    try:
+        total_pages = len(src.pages)
+        for start_page in range(1, total_pages + 1, chunk_size):
+            end_page = min(start_page + chunk_size - 1, total_pages)
+            yield start_page, end_page, chunk_bytes(src, start_page, end_page)
+    finally:
+        if owned:
+            close_pdf(src)